@@ -1,8 +1,10 @@
 import os
 import logging
 import json
+import hashlib
+import threading
 from datetime import datetime
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, request
 from apscheduler.schedulers.background import BackgroundScheduler
 from core_client import Client
 import time
@@ -27,26 +29,33 @@ api_password = os.environ.get('CORE_API_AUTH_PASSWORD', 'pass')
 database = {}
 prio = 0
 head = {}
+head_lock = threading.Lock()
 
 with open('/config/epg.json', 'r') as epg_json:
     epg = json.load(epg_json)
 epg_json.close()
 
-# Helper function to get process details
-def get_core_process_details(client, process_id):
-    try:
-        return client.v3_process_get(id=process_id)
-    except Exception as err:
-        logger_job.error(f'Error getting process details for {process_id}: {err}')
-        return None
-    
+# Index the epg by stream name, the first entry for a name wins
+epg_index = {}
+for entry in epg:
+    if "name" in entry:
+        epg_index.setdefault(entry["name"], entry)
+
+# Helper function to render the head response body and its etag
+def render_head(head):
+    # Same wire format as jsonify: compact separators and a trailing newline
+    body = (app.json.dumps(head, separators=(",", ":")) + "\n").encode()
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+head_response = render_head(head)
+
 # Helper function to process a running channel
 def process_running_channel(database, scheduler, stream_id, stream_name, stream_description, stream_hls_url):
     if stream_id in database:
         # Skip learned channels
         return
     else:
-        epg_result = find_event_entry(epg, stream_name)
+        epg_result = find_event_entry(epg_index, stream_name)
         stream_start = epg_result.get('start_at')
         stream_prio = epg_result.get('prio', 0)
         if stream_start == "never":
@@ -66,7 +75,7 @@ def process_running_channel(database, scheduler, stream_id, stream_name, stream_
         # Bootstrap the playhead if its still empty.
         if head == {}:
             fallback = fallback_search(database)
-            scheduler.add_job(func=stream_exec, id="fallback", args=(fallback['stream_id'], fallback['stream_name'], 0, fallback['stream_hls_url']))
+            scheduler.add_job(func=stream_exec, id="fallback", replace_existing=True, args=(fallback['stream_id'], fallback['stream_name'], 0, fallback['stream_hls_url']))
 
 # Helper function to remove channel from the database
 def remove_channel_from_database(database, scheduler, stream_id, stream_name, state):
@@ -80,65 +89,76 @@ def remove_channel_from_database(database, scheduler, stream_id, stream_name, st
         except Exception as joberror:
             logger_job.error(joberror)
         # Handle the situation where we remove an stream that is currently playing
-        if head['id'] == stream_id:
-            logger_job.warning(f'{stream_id} was currently running.')
-            fallback = fallback_search(database)
-            prio = 0
-            logger_job.warning(f'Source priority is reset to 0')
-            scheduler.add_job(func=stream_exec, id="fallback", args=(fallback['stream_id'], fallback['stream_name'], 0, fallback['stream_hls_url']))          
+        # Check and reset under the lock so a concurrent head switch is not overwritten
+        with head_lock:
+            if head.get('id') == stream_id:
+                logger_job.warning(f'{stream_id} was currently running.')
+                fallback = fallback_search(database)
+                prio = 0
+                logger_job.warning(f'Source priority is reset to 0')
+                scheduler.add_job(func=stream_exec, id="fallback", replace_existing=True, args=(fallback['stream_id'], fallback['stream_name'], 0, fallback['stream_hls_url']))
 
 # Helper function to search for a fallback stream
 def fallback_search(database):
     logger_job.warning('Searching for a fallback job.')
     current_hour = datetime.now().hour
-    hour_set = []               
+    fallback = None
+    closest_distance = None
+    # Track the closest start hour in a single pass over the database
     for key, value in database.items():
         if value['start_at'] == "now" or value['start_at'] == "never":
             continue
-        else:
-            hour_set.append(value['start_at'])
-        closest_hour = min(hour_set, key=lambda item: abs(int(item) - current_hour))
-        for key, value in database.items():
-            if value['start_at'] == str(closest_hour):
-                fallback = { "stream_id": key,
-                             "stream_name": value['name'],
-                             "stream_hls_url": value['src']
-                           }
-                return fallback
+        distance = abs(int(value['start_at']) - current_hour)
+        if closest_distance is None or distance < closest_distance:
+            closest_distance = distance
+            fallback = { "stream_id": key,
+                         "stream_name": value['name'],
+                         "stream_hls_url": value['src']
+                       }
+    return fallback
 
 # Helper function to find match a stream name with epg.json
-def find_event_entry(epg, stream_name):
-    for entry in epg:
-        if "name" in entry and entry["name"] == stream_name:
-            return {"start_at": entry.get("start_at"), "prio": entry.get("prio")}
-    return None
+def find_event_entry(epg_index, stream_name):
+    entry = epg_index.get(stream_name)
+    if entry is None:
+        return None
+    return {"start_at": entry.get("start_at"), "prio": entry.get("prio")}
 
 # Helper function to update the head
 def update_head(stream_id, stream_prio, stream_hls_url):
     global head
+    global head_response
     head = { "id": stream_id,
              "prio": stream_prio,
              "head": stream_hls_url }
+    # Render and encode once per switch instead of on every poll
+    head_response = render_head(head)
     logger_job.warning(f'Head position is: {str(head)}')
 
 # Tasks   
 def stream_exec(stream_id, stream_name, stream_prio, stream_hls_url):
     global prio
     logger_job.warning(f'Hello {stream_name}!')
-    if stream_prio > prio:
-        prio = stream_prio
-        logger_job.warning(f'Source priority is now set to: {prio}')
-        update_head(stream_id, stream_prio, stream_hls_url)
-    elif stream_prio == prio:
-        update_head(stream_id, stream_prio, stream_hls_url)
-    elif stream_prio < prio:
-        logger_job.warning(f'Source with higher priority ({prio}) is blocking. Skipping head update!') 
+    # Skip the lock if the stream is already the head
+    if stream_prio == prio and head.get('head') == stream_hls_url:
+        return
+    # Serialize head switches, jobs run concurrently in the scheduler thread pool
+    with head_lock:
+        if stream_prio > prio:
+            prio = stream_prio
+            logger_job.warning(f'Source priority is now set to: {prio}')
+            update_head(stream_id, stream_prio, stream_hls_url)
+        elif stream_prio == prio:
+            if head.get('head') != stream_hls_url:
+                update_head(stream_id, stream_prio, stream_hls_url)
+        elif stream_prio < prio:
+            logger_job.warning(f'Source with higher priority ({prio}) is blocking. Skipping head update!') 
 
 def core_api_sync():
     global database
     global epg
 
-    new_ids = []
+    new_ids = set()
     try:
         process_list = client.v3_process_get_list()
     except Exception as err:
@@ -146,19 +166,17 @@ def core_api_sync():
         return True
     for process in process_list:
         try:
-            get_process = get_core_process_details(client, process.id)
-            if not get_process:
-                continue
-            stream_id = get_process.reference
-            meta = get_process.metadata
-            state = get_process.state
+            # The list already carries state and metadata, no per-process lookup needed
+            stream_id = process.reference
+            meta = process.metadata
+            state = process.state
         except Exception as err:
             logger_job.error(f'Error processing {process.id}: {err}')
             continue
         if meta is None or meta['restreamer-ui'].get('meta') is None:
             # Skip processes without metadata or meta key
             continue
-        new_ids.append(stream_id)
+        new_ids.add(stream_id)
         stream_name = meta['restreamer-ui']['meta']['name']
         stream_description = meta['restreamer-ui']['meta']['description']
         stream_storage_type = meta['restreamer-ui']['control']['hls']['storage']
@@ -168,7 +186,7 @@ def core_api_sync():
             process_running_channel(database, scheduler, stream_id, stream_name, stream_description, stream_hls_url)
         else:
             remove_channel_from_database(database, scheduler, stream_id, stream_name, state)
-            new_ids.remove(stream_id)
+            new_ids.discard(stream_id)
 
     # Cleanup orphaned references
     orphan_keys = [key for key in database if key not in new_ids]
@@ -194,8 +212,11 @@ scheduler.start()
 
 @app.route('/', methods=['GET'])
 def root_query():
-    global head
-    return jsonify(head)
+    global head_response
+    body, etag = head_response
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 def create_app():
    return app